@@ -1,14 +1,21 @@
 #!/usr/bin/env python3
 import argparse
+import asyncio
 import serial
 import time
 import sys
 import os
 import io
 import select
+import struct
 from enum import Enum
 from typing import Optional
 
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
 EOL = b'\r\n'
 DEFAULT_BAUD_RATE = 115200
 DEFAULT_TIMEOUT = 5
@@ -20,6 +27,60 @@ ST_TYPE_DIRECTORY = 16384
 IDENT = '    '
 MAX_WRITE_PER_PASS = 64
 MAX_READ_PER_PASS = 64
+# Maximum number of bytes read from the asyncio stream reader at once
+ASYNC_READ_SIZE = 4096
+# Default value of timeout parameters, it means that the timeout of the syncer is used
+SYNCER_TIMEOUT = object()
+# Used when the block size of the remote filesystem cannot be queried with uos.statvfs
+DEFAULT_FLASH_BLOCK_SIZE = 4096
+# Upper limit for the device side upload buffer. On FAT, f_bsize is the cluster size, that can be
+# larger than the free heap (e.g. on ESP8266). Cluster sizes are multiples of this, so writes stay aligned.
+MAX_UPLOAD_BUFFER_SIZE = 4096
+
+# Device side upload buffer. _fw() stages data in a buffer of one filesystem block, and writes
+# full (block aligned) buffers only. _ff() writes the last partial block and closes the file.
+# Both of them measure the time spent with writing to the filesystem (in microseconds).
+# When the buffer cannot be allocated, then _fw() writes the data directly to the file.
+# A buffer flush that writes less than the whole buffer (e.g. the disk is full) raises OSError.
+# This must be executed before the file is opened, so a failure cannot leave an open file behind.
+UPLOAD_BUFFER_SETUP = "\r\n".join([
+    "import utime",
+    "try:",
+    "    _fbuf = bytearray(%d)",
+    "    _fmv = memoryview(_fbuf)",
+    "except MemoryError:",
+    "    _fbuf = _fmv = None",
+    "_fpos = 0",
+    "_ftime = 0",
+    "def _fwr(b):",
+    "    global _ftime",
+    "    t = utime.ticks_us()",
+    "    n = _fout.write(b)",
+    "    _ftime += utime.ticks_diff(utime.ticks_us(), t)",
+    "    return n",
+    "def _fw(d):",
+    "    global _fpos",
+    "    if _fbuf is None:",
+    "        return _fwr(d)",
+    "    n = len(d)",
+    "    _fmv[_fpos:_fpos + n] = d",
+    "    _fpos += n",
+    "    if _fpos == len(_fbuf):",
+    "        _fpos = 0",
+    "        if _fwr(_fbuf) != len(_fbuf):",
+    "            raise OSError('short write')",
+    "    return n",
+    "def _ff():",
+    "    global _ftime",
+    "    if _fpos and _fwr(_fmv[:_fpos]) != _fpos:",
+    "        raise OSError('short write')",
+    "    t = utime.ticks_us()",
+    "    _fout.close()",
+    "    _ftime += utime.ticks_diff(utime.ticks_us(), t)",
+    "    return _ftime",
+    "",
+])
+UPLOAD_BUFFER_CLEANUP = "del _fout, _fbuf, _fmv, _fpos, _ftime, _fwr, _fw, _ff"
 
 # http://www.physics.udel.edu/~watson/scen103/ascii.html
 CTRL_A = b'\x01'
@@ -30,6 +91,8 @@ CTRL_E = b'\x05'
 CTRL_F = b'\x06'
 CTRL_G = b'\x07'
 
+RAW_REPL_PROMPT = b'raw REPL; CTRL-B to exit\r\n>'
+
 
 class Commands(Enum):
     RESET = "reset"
@@ -75,10 +138,264 @@ class EspException(Exception):
         else:
             return None
 
+    def is_enoent(self):
+        """Tells if the device raised an OSError with ENOENT (e.g. the file does not exist)."""
+        last_line = self.last_line()
+        return bool(last_line and last_line.endswith('ENOENT'))
+
     def __str__(self):
         return "%s(%s)" % (self.__class__.__name__, repr(self.last_line()))
 
 
+def encode_command(cmd):
+    """Encode a single line of command, so that it can be sent to MicroPython prompt in paste mode."""
+    cmd = cmd.encode('ascii')
+    if not cmd.endswith(EOL):
+        cmd += EOL
+    return cmd
+
+
+def parse_command_result(cmd, result, expect_echo):
+    """Process the result of an encoded command that was sent in paste mode.
+
+    Raises EspException when the command raised an exception on the device."""
+    if expect_echo:
+        assert result.startswith(cmd)
+        result = result[len(cmd):]
+    result = result.decode('ascii')
+    if 'Traceback (most recent call last):' in result:
+        raise EspException(result)
+    return result
+
+
+def uos_command(func, relpath, check=False):
+    """Return a command that calls uos.<func>(relpath).
+
+    When check is set, then the command evaluates to True when the call was successful."""
+    cmd = "uos.%s(%s)" % (func, repr(relpath))
+    if check:
+        cmd += " or True"
+    return cmd
+
+
+def ilistdir_command(relpath):
+    """Return the (multi line) command that prints the items of uos.ilistdir(relpath)."""
+    return ("for i in uos.ilistdir(%s):\r\n    print(i)\r\n" % repr(relpath)).encode("ascii")
+
+
+def parse_ilistdir(output):
+    """Parse the output of ilistdir_command() and return the items as a python list."""
+    TERM = b"print(i)\r\n=== \n"
+    idx = output.find(TERM)
+    assert idx
+    items = []
+    for lidx, line in enumerate(output[idx + len(TERM):].split(b"\r\n")):
+        if lidx == 0:
+            assert line == b''
+        else:
+            item = eval(line.strip())
+            items.append(item)
+    return items
+
+
+def split_items(items):
+    """Split ilistdir items into sorted lists of directory names and file names."""
+    dnames, fnames = [], []
+    for item in items:
+        name, type = item[:2]
+        if type == ST_TYPE_FILE:
+            fnames.append(name)
+        if type == ST_TYPE_DIRECTORY:
+            dnames.append(name)
+    return sorted(dnames), sorted(fnames)
+
+
+def ls_items(items):
+    """Return directory and file names from ilistdir items (directory names end with /)"""
+    dnames, fnames = split_items(items)
+    return [dname + "/" for dname in dnames] + fnames
+
+
+def lsl_items(items):
+    """Return (filename, size) tuples from ilistdir items, directory names end with /."""
+    dnames, fnames = [], []
+    for item in items:
+        name, type, inode, size = item
+        if type == ST_TYPE_FILE:
+            fnames.append((name, size))
+        if type == ST_TYPE_DIRECTORY:
+            dnames.append((name + "/", 0))
+    return sorted(dnames) + sorted(fnames)
+
+
+def remote_join(dirpath, name):
+    """Join a remote directory path and a name."""
+    if dirpath == "/":
+        return "/" + name
+    else:
+        return dirpath + "/" + name
+
+
+def remote_parents(realpath):
+    """Yield all directory paths that makedirs needs to create for realpath, starting from the top."""
+    assert realpath.startswith("/")
+    parts = realpath[1:].split("/")
+    for idx in range(len(parts)):
+        yield "/" + "/".join(parts[:idx + 1])
+
+
+def parse_block_size(block_size):
+    """Return the upload buffer size, for the f_bsize value returned by uos.statvfs."""
+    if not block_size or block_size < 0:
+        return DEFAULT_FLASH_BLOCK_SIZE
+    return min(block_size, MAX_UPLOAD_BUFFER_SIZE)
+
+
+class UploadProgress:
+    """Transport independent part of uploading a single file: checks, chunking and progress logging."""
+
+    def __init__(self, src, dst, st: Optional[StatResult], overwrite, logger):
+        if st and not overwrite:
+            raise Exception("Destination %s already exist." % dst)
+        if st and st.isdir:
+            raise Exception("Cannot overwrite a directory with a file: %s -> %s" % (src, dst))
+        self.src = src
+        self.dst = dst
+        self.st = st
+        self.logger = logger
+        self.data = b''
+        self.block_size = DEFAULT_FLASH_BLOCK_SIZE
+        self.full_size = 0
+        self.total_written = 0
+        self.lcnt = 0
+        self.started = None
+
+    def skip(self, quick):
+        """Return True (and log it) when the upload can be skipped."""
+        if quick and self.st is not None and os.stat(self.src).st_size == self.st.size:
+            self.logger('SKIP ' + self.dst + '\n')
+            return True
+        return False
+
+    def read(self):
+        """Read the contents of the local source file."""
+        with open(self.src, "rb") as fin:
+            self.data = fin.read()
+        self.full_size = len(self.data)
+
+    def start(self, block_size):
+        self.block_size = block_size
+        self.logger('UPLOAD ' + self.dst + '\n    ')
+
+    @property
+    def done(self):
+        return not self.data
+
+    def next_command(self):
+        """Return the command that writes the next chunk on the device."""
+        # Never cross a block boundary, so the device side buffer is always flushed when it is full.
+        size = min(MAX_WRITE_PER_PASS, self.block_size - self.total_written % self.block_size)
+        return "_fw(%s)" % repr(self.data[:size])
+
+    def written(self, written):
+        self.total_written += written
+        self.data = self.data[written:]
+        self.logger('.')
+        self.lcnt += 1
+        if self.lcnt % 16 == 0:
+            percent = 100.0 * self.total_written / self.full_size
+            self.logger(' %.2fK, %.2f%% \n    ' % (self.total_written / 1024.0, percent))
+
+    def finish(self, elapsed, write_time):
+        self.logger(' -- %.2f KB OK, link %.2fs, device write %.2fs\n' %
+                    (self.total_written / 1024.0, elapsed - write_time, write_time))
+
+
+class DownloadProgress:
+    """Transport independent part of downloading a single file: checks and progress logging."""
+    READ_COMMAND = "_fin.read(%s)" % repr(MAX_READ_PER_PASS)
+
+    def __init__(self, src, dst, overwrite, logger):
+        if os.path.isdir(dst):
+            raise Exception("Cannot overwrite a directory with a file: %s -> %s" % (src, dst))
+        if os.path.isfile(dst) and not overwrite:
+            raise Exception("Destination file %s already exist." % dst)
+        self.dst = dst
+        self.logger = logger
+        self.total_read = 0
+        self.lcnt = 0
+
+    def skip(self, st: Optional[StatResult]):
+        """Return True (and log it) when the download can be skipped, st is the stat of the source."""
+        if st is not None and os.path.isfile(self.dst) and os.stat(self.dst).st_size == st.size:
+            self.logger('SKIP ' + self.dst + '\n')
+            return True
+        return False
+
+    def start(self):
+        self.logger('DOWNLOAD ' + self.dst + '\n    ')
+
+    def received(self, data):
+        self.lcnt += 1
+        self.logger('.')
+        if self.lcnt % 16 == 0:
+            self.logger(' %.2fK \n    ' % (self.total_read / 1024.0))
+        self.total_read += len(data)
+
+    def finish(self):
+        self.logger(' -- %.2f KB OK\n' % (self.total_read / 1024.0))
+
+
+class RawReplOutput:
+    """Removes the framing from the output of the raw REPL.
+
+    After execution, the raw REPL prints stdout, CTRL_D, stderr, CTRL_D and then its prompt (>)."""
+
+    def __init__(self):
+        self.separators = 0
+        self.finished = False
+        self.rest = b''
+
+    def feed(self, data):
+        """Return the stdout and stderr sections of data. Data after the prompt is collected in rest."""
+        result = b''
+        while data and not self.finished:
+            if self.separators < 2:
+                idx = data.find(CTRL_D)
+                if idx < 0:
+                    result += data
+                    data = b''
+                else:
+                    result += data[:idx]
+                    data = data[idx + 1:]
+                    self.separators += 1
+            else:
+                if data.startswith(b'>'):
+                    data = data[1:]
+                self.finished = True
+        self.rest += data
+        return result
+
+
+def download_path(src, dst):
+    """Local destination path for downloading the remote src into the local dst directory."""
+    fname = os.path.split(src)[1]
+    # Only on unix
+    if dst == "/":
+        return "/" + fname
+    else:
+        return os.path.join(dst, fname)
+
+
+def check_download_dir(src, dst, dst_path, logger):
+    """Create the local directory for downloading a remote directory, when needed."""
+    if not os.path.isfile(dst_path) and not os.path.isdir(dst_path):
+        logger("MKDIR " + dst_path + "\n")
+        os.mkdir(dst_path)
+    elif os.path.isfile(dst_path):
+        raise Exception("upload: cannot overwrite a file with a directory: %s -> %s" % (src, dst))
+
+
 class EspSyncer:
     def __init__(self, ser: serial.Serial, timeout, logger):
         self.ser = ser
@@ -121,6 +438,19 @@ class EspSyncer:
         self.buffer = self.buffer[idx + len(terminator):]
         return chunk
 
+    def recv_exactly(self, size):
+        """Receive exactly size bytes from the device."""
+        started = time.time()
+        while len(self.buffer) < size:
+            self.buffer += self.ser.read(size - len(self.buffer))
+            elapsed = time.time() - started
+            if self.timeout is not None and elapsed > self.timeout:
+                raise TimeoutError
+
+        chunk = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return chunk
+
     def dump(self):
         while True:
             data = self.ser.read()
@@ -137,8 +467,9 @@ class EspSyncer:
         self.recv(terminator=b'raw REPL; CTRL-B to exit\r\n')
 
     def exit_raw_mode(self):
+        # The friendly REPL prints its banner and prompt.
         self.send(CTRL_B)
-        self.recv(terminator=b'OK\r\n')
+        self.recv(DEFAULT_TERMINATOR)
 
     def enter_paste_mode(self):
         self.send(CTRL_E)
@@ -146,9 +477,56 @@ class EspSyncer:
     def exit_paste_mode(self):
         self.send(CTRL_D)
 
+    def raw_paste(self, data):
+        """Send data to the device in raw-paste mode, and start executing it.
+
+        Raw-paste mode does not echo the data back, and it uses window-size flow control,
+        so the UART buffer of the device cannot be overrun.
+        See https://docs.micropython.org/en/latest/reference/repl.html#raw-mode-and-raw-paste-mode
+
+        :param data: Binary data (python source) to be executed.
+        :return: True when the data was sent. The device stays in raw REPL mode until the execution
+            is finished, and its output is framed by the raw REPL (see RawReplOutput). False when the
+            firmware does not support raw-paste mode. In this case nothing was executed, and the device
+            is returned to the normal REPL.
+        """
+        self.send(CTRL_A)
+        self.recv(RAW_REPL_PROMPT)
+        self.send(CTRL_E + b'A' + CTRL_A)
+        response = self.recv_exactly(2)
+        if response != b'R\x01':
+            if response != b'R\x00':
+                # The firmware does not know raw-paste mode. It handles CTRL_A as a raw REPL reset,
+                # and prints the prompt again (the first two bytes are already consumed).
+                self.recv(b'CTRL-B to exit\r\n>')
+            self.exit_raw_mode()
+            return False
+
+        window_size = struct.unpack('<H', self.recv_exactly(2))[0]
+        window_remain = window_size
+        idx = 0
+        while idx < len(data):
+            while window_remain == 0 or self.buffer or self.ser.in_waiting:
+                flag = self.recv_exactly(1)
+                if flag == CTRL_A:
+                    window_remain += window_size
+                elif flag == CTRL_D:
+                    # The device wants to end the transfer (e.g. syntax error), acknowledge it.
+                    self.send(CTRL_D)
+                    return True
+                else:
+                    raise EspException("Unexpected flow control byte in raw-paste mode: %r" % flag)
+            chunk = data[idx:idx + window_remain]
+            self.send(chunk)
+            window_remain -= len(chunk)
+            idx += len(chunk)
+        self.send(CTRL_D)
+        self.recv(CTRL_D)
+        return True
+
     def communicate(self, stdin, stdout, stdin_encoding=None, stdout_encoding=None,
                     absolute_timeout=None, timeout=1, paste_mode=True, watch_file_path=None,
-                    no_select=False, terminator=None):
+                    no_select=False, terminator=None, raw_paste=False):
         """Communicate with device. Connects stdin and stdout with the serial line of the device.
 
         :param stdin: Input file (file-like object)
@@ -166,10 +544,16 @@ class EspSyncer:
             the input file is read continuously when data is available (it is checked with select.select).
         :param terminator: When given, it should be a binary string. This method will exist when it
             encounters the given terminator in the MCU's serial output.
+        :param raw_paste: Send all data in raw-paste mode (see raw_paste()), and fall back to paste mode
+            when the firmware does not support it. Effective ONLY when no_select is set. The framing of
+            the raw REPL is removed from the output, and the device is returned to the normal REPL when
+            the execution is finished. When the terminator is DEFAULT_TERMINATOR, then this method
+            exits at that point.
         """
-        if paste_mode:
-            self.enter_paste_mode()
         sendbuf = b''
+        pending = b''
+        tail = b''
+        raw_output = None
         started, absolute_elapsed = time.time(), 0
         last_comm, elapsed = started, 0
         eof_reached = False
@@ -185,6 +569,15 @@ class EspSyncer:
             if not isinstance(sendbuf, bytes):
                 sendbuf = sendbuf.encode('utf-8')
             eof_reached = True
+        if raw_paste and no_select and self.raw_paste(sendbuf):
+            sendbuf = b''
+            paste_mode_exited = True
+            # Output that was received together with the end of the transfer.
+            pending, self.buffer = self.buffer, b''
+            last_comm = time.time()
+            raw_output = RawReplOutput()
+        elif paste_mode:
+            self.enter_paste_mode()
         while True:
             was_comm = False
 
@@ -214,8 +607,11 @@ class EspSyncer:
                 was_comm = True
 
             # MCU -> stdout
-            if self.ser.in_waiting:
-                data = self.ser.read(self.ser.in_waiting)
+            if pending or self.ser.in_waiting:
+                data = pending + self.ser.read(self.ser.in_waiting)
+                pending = b''
+                if raw_output is not None:
+                    data = raw_output.feed(data)
                 if stdout is not None:
                     if stdout_encoding:
                         stdout.write(data.decode(stdout_encoding))
@@ -223,10 +619,18 @@ class EspSyncer:
                         stdout.write(data)
                     stdout.flush()
                 was_comm = True
-                # TODO: what if the terminator is slit between two reads?
+                if raw_output is not None and raw_output.finished:
+                    # Execution finished, return to the friendly REPL (where we started from).
+                    self.buffer = raw_output.rest + self.buffer
+                    raw_output = None
+                    self.exit_raw_mode()
+                    if terminator == DEFAULT_TERMINATOR:
+                        return False
                 if terminator is not None:
-                    if terminator in data:
+                    # The terminator may be split between two reads.
+                    if terminator in tail + data:
                         return False
+                    tail = (tail + data)[-len(terminator):]
 
             now = time.time()
             absolute_elapsed = now - started
@@ -250,20 +654,11 @@ class EspSyncer:
 
     def __call__(self, cmd, terminator=DEFAULT_TERMINATOR, expect_echo=True):
         """Send a single line of command and return the result."""
-        cmd = cmd.encode('ascii')
-        if not cmd.endswith(EOL):
-            cmd += EOL
+        cmd = encode_command(cmd)
         self.enter_paste_mode()
         self.send(cmd)
         self.exit_paste_mode()
-        result = self.recv(terminator)
-        if expect_echo:
-            assert result.startswith(cmd)
-            result = result[len(cmd):]
-        result = result.decode('ascii')
-        if 'Traceback (most recent call last):' in result:
-            raise EspException(result)
-        return result
+        return parse_command_result(cmd, self.recv(terminator), expect_echo)
 
     def eval(self, cmd):
         """Similar to __call__ but it interprets the result as a python data structure source."""
@@ -275,65 +670,29 @@ class EspSyncer:
     def ilistdir(self, relpath):
         """This executes uos.ilistdir(relpath) and returns its result as a python list."""
         self.enter_paste_mode()
-        self.send(("for i in uos.ilistdir(%s):\r\n    print(i)\r\n" % repr(relpath)).encode("ascii"))
+        self.send(ilistdir_command(relpath))
         self.exit_paste_mode()
-        output = self.recv(DEFAULT_TERMINATOR)
-        TERM = b"print(i)\r\n=== \n"
-        idx = output.find(TERM)
-        assert idx
-        items = []
-        for lidx, line in enumerate(output[idx + len(TERM):].split(b"\r\n")):
-            if lidx == 0:
-                assert line == b''
-            else:
-                item = eval(line.strip())
-                items.append(item)
-        return items
+        return parse_ilistdir(self.recv(DEFAULT_TERMINATOR))
 
     def ls(self, relpath):
         """Yield directory and file names (directory names end with /)"""
-        items = self.ilistdir(relpath)
-        dnames, fnames = [], []
-        for item in items:
-            name, type = item[:2]
-            if type == ST_TYPE_FILE:
-                fnames.append(name)
-            if type == ST_TYPE_DIRECTORY:
-                dnames.append(name)
-        for dname in sorted(dnames):
-            yield dname + "/"
-        for fname in sorted(fnames):
-            yield fname
+        yield from ls_items(self.ilistdir(relpath))
 
     def lsl(self, relpath):
         """Yield tuples of (filename, size), directory names end with /."""
-        items = self.ilistdir(relpath)
-        dnames, fnames = [], []
-        for item in items:
-            name, type, inode, size = item
-            if type == ST_TYPE_FILE:
-                fnames.append((name, size))
-            if type == ST_TYPE_DIRECTORY:
-                dnames.append((name + "/", 0))
-        for dname in sorted(dnames):
-            yield dname
-        for fname in sorted(fnames):
-            yield fname
+        yield from lsl_items(self.ilistdir(relpath))
 
     def rm(self, relpath):
-        assert self.eval("uos.remove(%s) or True" % repr(relpath)) is True
+        assert self.eval(uos_command("remove", relpath, check=True)) is True
 
     def rmdir(self, relpath):
-        assert self.eval("uos.rmdir(%s) or True" % repr(relpath)) is True
+        assert self.eval(uos_command("rmdir", relpath, check=True)) is True
 
     def mkdir(self, relpath):
-        assert self.eval("uos.mkdir(%s) or True" % repr(relpath)) is True
+        assert self.eval(uos_command("mkdir", relpath, check=True)) is True
 
     def makedirs(self, realpath):
-        assert realpath.startswith("/")
-        parts = realpath[1:].split("/")
-        for idx in range(len(parts)):
-            path = "/" + "/".join(parts[:idx + 1])
+        for path in remote_parents(realpath):
             st = self.stat(path)
             if st is None:
                 self.mkdir(path)
@@ -345,14 +704,11 @@ class EspSyncer:
 
     def stat(self, relpath) -> Optional[StatResult]:
         try:
-            st = self.eval("uos.stat(%s)" % repr(relpath))
-            return StatResult(st)
+            return StatResult(self.eval(uos_command("stat", relpath)))
         except EspException as e:
-            last_line = e.last_line()
-            if last_line and last_line.endswith('ENOENT'):
+            if e.is_enoent():
                 return None
-            else:
-                raise e
+            raise e
 
     def rmtree(self, relpath, ident='', isdir=None):
         """Delete all files and directories from the flash.
@@ -373,24 +729,11 @@ class EspSyncer:
             isdir = self.stat(relpath).isdir
 
         if isdir:
-            items = self.ilistdir(relpath)
-            dnames, fnames = [], []
-            for item in items:
-                name, type = item[:2]
-                if type == ST_TYPE_FILE:
-                    fnames.append(name)
-                if type == ST_TYPE_DIRECTORY:
-                    dnames.append(name)
-            for dname in sorted(dnames):
-                if relpath == '/':
-                    self.rmtree('/' + dname, isdir=True)
-                else:
-                    self.rmtree(relpath + '/' + dname, isdir=True)
-            for fname in sorted(fnames):
-                if relpath == '/':
-                    fpath = '/' + fname
-                else:
-                    fpath = relpath + '/' + fname
+            dnames, fnames = split_items(self.ilistdir(relpath))
+            for dname in dnames:
+                self.rmtree(remote_join(relpath, dname), isdir=True)
+            for fname in fnames:
+                fpath = remote_join(relpath, fname)
                 self.logger("RM %s\n" % fpath)
                 self.rm(fpath)
             if relpath != '/':
@@ -400,46 +743,39 @@ class EspSyncer:
             self.logger(ident + "RM " + relpath + "\n")
             self.rm(relpath)
 
+    def block_size(self, relpath):
+        """Return the block size of the filesystem that contains the given remote path."""
+        parent = relpath.rsplit("/", 1)[0] or "/"
+        try:
+            return parse_block_size(self.eval(uos_command("statvfs", parent) + "[0]"))
+        except EspException:
+            return DEFAULT_FLASH_BLOCK_SIZE
+
     def _upload_file(self, src, dst, overwrite, quick):
         """Internal method, to not use directly."""
-        st = self.stat(dst)
-        if st and not overwrite:
-            raise Exception("Destination %s already exist." % dst)
-        if st and st.isdir:
-            raise Exception("Cannot overwrite a directory with a file: %s -> %s" % (src, dst))
-        with open(src, "rb") as fin:
-            data = fin.read()
-
-        if quick:
-            src_size = os.stat(src).st_size
-            if st is not None and src_size == st.size:
-                self.logger('SKIP ' + dst + '\n')
-                return
+        progress = UploadProgress(src, dst, self.stat(dst), overwrite, self.logger)
+        if progress.skip(quick):
+            return
 
-        self.logger('UPLOAD ' + dst + '\n    ')
+        started = time.time()
+        progress.read()
+        progress.start(self.block_size(dst))
+        self(UPLOAD_BUFFER_SETUP % progress.block_size, expect_echo=False)
         self("_fout = open(%s,'wb+')" % repr(dst), expect_echo=False)
-        lcnt = 0
-        full_size = len(data)
-        total_written = 0
-        while data:
-            written = self.eval("_fout.write(%s)" % repr(data[:MAX_WRITE_PER_PASS]))
-            total_written += written
-            data = data[written:]
-            self.logger('.')
-            lcnt += 1
-            if lcnt % 16 == 0:
-                percent = 100.0 * total_written / full_size
-                self.logger(' %.2fK, %.2f%% \n    ' % (total_written / 1024.0, percent))
-        self("_fout.close()", expect_echo=False)
-        self("del _fout", expect_echo=False)
-        self.logger(' -- %.2f KB OK\n' % (total_written / 1024.0))
+        try:
+            while not progress.done:
+                progress.written(self.eval(progress.next_command()))
+            write_time = self.eval("_ff()") / 1000000.0
+        except EspException:
+            # Do not leave an open file behind on the device.
+            self("_fout.close()", expect_echo=False)
+            self(UPLOAD_BUFFER_CLEANUP, expect_echo=False)
+            raise
+        self(UPLOAD_BUFFER_CLEANUP, expect_echo=False)
+        progress.finish(time.time() - started, write_time)
 
     def _upload(self, src, dst, overwrite, quick):
-        fname = os.path.split(src)[1]
-        if dst == "/":
-            dst_path = "/" + fname
-        else:
-            dst_path = dst + "/" + fname
+        dst_path = remote_join(dst, os.path.split(src)[1])
 
         if os.path.isdir(src):
             st = self.stat(dst_path)
@@ -482,60 +818,33 @@ class EspSyncer:
 
     def _download_file(self, src, dst, overwrite, quick):
         """Internal method, to not use directly."""
-        if os.path.isdir(dst):
-            raise Exception("Cannot overwrite a directory with a file: %s -> %s" % (src, dst))
-        if os.path.isfile(dst) and not overwrite:
-            raise Exception("Destination file %s already exist." % dst)
-
-        if quick:
-            st = self.stat(src)
-            if st is not None:
-                if os.path.isfile(dst):
-                    dst_size = os.stat(dst).st_size
-                    if dst_size == st.size:
-                        self.logger('SKIP ' + dst + '\n')
-                        return
+        progress = DownloadProgress(src, dst, overwrite, self.logger)
+        if quick and progress.skip(self.stat(src)):
+            return
 
         self("_fin = open(%s,'rb')" % repr(src), expect_echo=False)
-        self.logger('DOWNLOAD ' + dst + '\n    ')
+        progress.start()
         with open(dst, "wb+") as fout:
-            lcnt = 0
-            total_read = 0
             while True:
-                data = self.eval("_fin.read(%s)" % repr(MAX_READ_PER_PASS))
+                data = self.eval(DownloadProgress.READ_COMMAND)
                 if not data:
                     break
                 fout.write(data)
-                lcnt += 1
-                self.logger('.')
-                if lcnt % 16 == 0:
-                    self.logger(' %.2fK \n    ' % (total_read / 1024.0))
-                total_read += len(data)
+                progress.received(data)
 
         self("_fin.close()", expect_echo=False)
         self("del _fin", expect_echo=False)
-        self.logger(' -- %.2f KB OK\n' % (total_read / 1024.0))
+        progress.finish()
 
     def _download(self, src, dst, overwrite, quick, isdir=None):
-        fname = os.path.split(src)[1]
-        # Only on unix
-        if dst == "/":
-            dst_path = "/" + fname
-        else:
-            dst_path = os.path.join(dst, fname)
+        dst_path = download_path(src, dst)
 
         if isdir is None:
             isdir = self.stat(src).isdir
 
         if isdir:
-            if not os.path.isfile(dst_path) and not os.path.isdir(dst_path):
-                self.logger("MKDIR " + dst_path + "\n")
-                os.mkdir(dst_path)
-            elif os.path.isfile(dst_path):
-                raise Exception("upload: cannot overwrite a file with a directory: %s -> %s" % (src, dst))
-
-            items = self.ilistdir(src)
-            for item in items:
+            check_download_dir(src, dst, dst_path, self.logger)
+            for item in self.ilistdir(src):
                 name, type = item[:2]
                 src_path = src + "/" + name
                 if type == ST_TYPE_FILE:
@@ -569,6 +878,339 @@ class EspSyncer:
             self._download(src, dst, overwrite, quick)
 
 
+class AsyncEspSyncer:
+    """Asyncio counterpart of EspSyncer.
+
+    It works on an asyncio stream pair (reader, writer) instead of a blocking serial.Serial object,
+    so many devices can be driven concurrently from a single event loop. Use open_async_syncer() to
+    create one for a serial port.
+
+    The ser parameter is the serial.Serial object behind the streams. It is only used by reset(),
+    to toggle the DTR and RTS lines. When it is None, then reset() is not available.
+
+    Contents of local files are read and written in the default executor of the event loop. Other local
+    filesystem calls (stat, listdir, mkdir) are quick, and they are made directly on the event loop."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, timeout, logger,
+                 ser: Optional[serial.Serial] = None):
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.logger = logger
+        self.ser = ser
+        self.buffer = b''
+        self.uos_imported = False
+
+    async def reset(self):
+        if self.ser is None:
+            raise Exception("reset: the serial object of the device was not given")
+        self.ser.setDTR(False)  # IO0=HIGH
+        self.ser.setRTS(True)  # EN=LOW, chip in reset
+        await asyncio.sleep(0.5)
+        self.ser.setRTS(False)  # EN=LOW, chip in reset
+        await self.recv(b">>>")
+
+    async def send(self, data):
+        """Send data to MicroPython prompt."""
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def read(self, timeout):
+        """Read the next chunk of data from the device. Returns an empty string at end of stream."""
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+            return data
+        try:
+            return await asyncio.wait_for(self.reader.read(ASYNC_READ_SIZE), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError("TimeoutError")
+
+    async def recv(self, terminator=DEFAULT_TERMINATOR):
+        """Receive data from MicroPython prompt.
+
+        This receives data until the given terminator."""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while terminator not in self.buffer:
+            timeout = None
+            if self.timeout is not None:
+                timeout = max(0, started + self.timeout - loop.time())
+            try:
+                data = await asyncio.wait_for(self.reader.read(ASYNC_READ_SIZE), timeout)
+            except asyncio.TimeoutError:
+                raise TimeoutError
+            if not data:
+                raise EspException("Connection closed before the terminator was received: %r" % self.buffer)
+            self.buffer += data
+
+        idx = self.buffer.find(terminator)
+        chunk = self.buffer[:idx]
+        self.buffer = self.buffer[idx + len(terminator):]
+        return chunk
+
+    async def output(self, terminator=None, timeout=SYNCER_TIMEOUT):
+        """Asynchronous iterator over the output of the device.
+
+        :param terminator: When given, it should be a binary string. Iteration stops with the chunk
+            that ends with the given terminator. Data after the terminator is kept for the next read.
+        :param timeout: Timeout between two chunks. Defaults to the timeout of the syncer, None means infinite.
+        """
+        if timeout is SYNCER_TIMEOUT:
+            timeout = self.timeout
+        tail = b''
+        while True:
+            data = await self.read(timeout)
+            if not data:
+                return
+            if terminator is not None:
+                # The terminator may be split between two reads.
+                idx = (tail + data).find(terminator)
+                if idx >= 0:
+                    end = idx + len(terminator) - len(tail)
+                    self.buffer = data[end:]
+                    yield data[:end]
+                    return
+                tail = (tail + data)[-len(terminator):]
+            yield data
+
+    async def __call__(self, cmd, terminator=DEFAULT_TERMINATOR, expect_echo=True):
+        """Send a single line of command and return the result."""
+        cmd = encode_command(cmd)
+        await self.send(CTRL_E + cmd + CTRL_D)
+        return parse_command_result(cmd, await self.recv(terminator), expect_echo)
+
+    async def eval(self, cmd):
+        """Similar to __call__ but it interprets the result as a python data structure source."""
+        if not self.uos_imported:
+            await self("import uos", expect_echo=False)
+            self.uos_imported = True
+        return eval(await self(cmd))
+
+    async def execute(self, source, terminator=DEFAULT_TERMINATOR, timeout=SYNCER_TIMEOUT):
+        """Execute python source on the device (in paste mode).
+
+        :param source: Source code to be executed (str or bytes).
+        :param terminator: When given, the output of the device is collected until the terminator
+            is found, and it is returned. When None, this returns immediately after the source was
+            sent, and the output can be processed with output().
+        :param timeout: Timeout between two chunks of output. Defaults to the timeout of the syncer,
+            None means infinite.
+        """
+        if not isinstance(source, bytes):
+            source = source.encode('utf-8')
+        await self.send(CTRL_E + source + CTRL_D)
+        if terminator is None:
+            return None
+        chunks = []
+        async for chunk in self.output(terminator, timeout):
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    async def ilistdir(self, relpath):
+        """This executes uos.ilistdir(relpath) and returns its result as a python list."""
+        await self.send(CTRL_E + ilistdir_command(relpath) + CTRL_D)
+        return parse_ilistdir(await self.recv(DEFAULT_TERMINATOR))
+
+    async def ls(self, relpath):
+        """Return directory and file names (directory names end with /)"""
+        return ls_items(await self.ilistdir(relpath))
+
+    async def lsl(self, relpath):
+        """Return a list of (filename, size) tuples, directory names end with /."""
+        return lsl_items(await self.ilistdir(relpath))
+
+    async def rm(self, relpath):
+        assert await self.eval(uos_command("remove", relpath, check=True)) is True
+
+    async def rmdir(self, relpath):
+        assert await self.eval(uos_command("rmdir", relpath, check=True)) is True
+
+    async def mkdir(self, relpath):
+        assert await self.eval(uos_command("mkdir", relpath, check=True)) is True
+
+    async def makedirs(self, realpath):
+        for path in remote_parents(realpath):
+            st = await self.stat(path)
+            if st is None:
+                await self.mkdir(path)
+            elif not st.isdir:
+                raise Exception(
+                    "Wanted to create directory %s but it already exists and it is not a directory." %
+                    path
+                )
+
+    async def stat(self, relpath) -> Optional[StatResult]:
+        try:
+            return StatResult(await self.eval(uos_command("stat", relpath)))
+        except EspException as e:
+            if e.is_enoent():
+                return None
+            raise e
+
+    async def rmtree(self, relpath, ident='', isdir=None):
+        """Delete all files and directories from the flash. See EspSyncer.rmtree for details."""
+        # Normalize path
+        assert relpath and relpath.startswith('/')
+        if relpath != "/" and relpath.endswith("/"):
+            relpath = relpath[:-1]
+
+        if isdir is None:
+            isdir = (await self.stat(relpath)).isdir
+
+        if isdir:
+            dnames, fnames = split_items(await self.ilistdir(relpath))
+            for dname in dnames:
+                await self.rmtree(remote_join(relpath, dname), isdir=True)
+            for fname in fnames:
+                fpath = remote_join(relpath, fname)
+                self.logger("RM %s\n" % fpath)
+                await self.rm(fpath)
+            if relpath != '/':
+                self.logger("RMDIR %s\n" % relpath)
+                await self.rmdir(relpath)
+        else:
+            self.logger(ident + "RM " + relpath + "\n")
+            await self.rm(relpath)
+
+    async def block_size(self, relpath):
+        """Return the block size of the filesystem that contains the given remote path."""
+        parent = relpath.rsplit("/", 1)[0] or "/"
+        try:
+            return parse_block_size(await self.eval(uos_command("statvfs", parent) + "[0]"))
+        except EspException:
+            return DEFAULT_FLASH_BLOCK_SIZE
+
+    async def _upload_file(self, src, dst, overwrite, quick):
+        """Internal method, to not use directly."""
+        progress = UploadProgress(src, dst, await self.stat(dst), overwrite, self.logger)
+        if progress.skip(quick):
+            return
+
+        started = time.time()
+        # Local file I/O is done in the default executor, so it does not block the event loop.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, progress.read)
+        progress.start(await self.block_size(dst))
+        await self(UPLOAD_BUFFER_SETUP % progress.block_size, expect_echo=False)
+        await self("_fout = open(%s,'wb+')" % repr(dst), expect_echo=False)
+        try:
+            while not progress.done:
+                progress.written(await self.eval(progress.next_command()))
+            write_time = await self.eval("_ff()") / 1000000.0
+        except EspException:
+            # Do not leave an open file behind on the device.
+            await self("_fout.close()", expect_echo=False)
+            await self(UPLOAD_BUFFER_CLEANUP, expect_echo=False)
+            raise
+        await self(UPLOAD_BUFFER_CLEANUP, expect_echo=False)
+        progress.finish(time.time() - started, write_time)
+
+    async def _upload(self, src, dst, overwrite, quick):
+        dst_path = remote_join(dst, os.path.split(src)[1])
+
+        if os.path.isdir(src):
+            st = await self.stat(dst_path)
+            if st is None:
+                self.logger("MKDIR " + dst_path + "\n")
+                await self.mkdir(dst_path)
+            elif st.isfile:
+                raise Exception("upload: cannot overwrite a file with a directory: %s -> %s" % (src, dst))
+
+            for fname in sorted(os.listdir(src)):
+                if fname not in [os.pardir, os.curdir]:
+                    await self._upload(os.path.join(src, fname), dst_path, overwrite, quick)
+        elif os.path.isfile(src):
+            await self._upload_file(src, dst_path, overwrite, quick)
+        else:
+            raise Exception("Source is not a regular file or directory: %s" % src)
+
+    async def upload(self, src, dst, contents, overwrite, quick):
+        """Upload local files to the device. See EspSyncer.upload for the parameters."""
+        st = await self.stat(dst)
+        if st is not None and not st.isdir:
+            raise Exception("upload: cannot upload to non-existent directory %s" % dst)
+
+        if contents:
+            if not os.path.isdir(src):
+                raise Exception("upload: --contents was given but the source %s is not a directory" % src)
+            for fname in sorted(os.listdir(src)):
+                if fname not in [os.pardir, os.curdir]:
+                    await self._upload(os.path.join(src, fname), dst, overwrite, quick)
+        else:
+            await self._upload(src, dst, overwrite, quick)
+
+    async def _download_file(self, src, dst, overwrite, quick):
+        """Internal method, to not use directly."""
+        progress = DownloadProgress(src, dst, overwrite, self.logger)
+        if quick and progress.skip(await self.stat(src)):
+            return
+
+        await self("_fin = open(%s,'rb')" % repr(src), expect_echo=False)
+        progress.start()
+        # Local file I/O is done in the default executor, so it does not block the event loop.
+        loop = asyncio.get_running_loop()
+        fout = await loop.run_in_executor(None, open, dst, "wb+")
+        try:
+            while True:
+                data = await self.eval(DownloadProgress.READ_COMMAND)
+                if not data:
+                    break
+                await loop.run_in_executor(None, fout.write, data)
+                progress.received(data)
+        finally:
+            await loop.run_in_executor(None, fout.close)
+
+        await self("_fin.close()", expect_echo=False)
+        await self("del _fin", expect_echo=False)
+        progress.finish()
+
+    async def _download(self, src, dst, overwrite, quick, isdir=None):
+        dst_path = download_path(src, dst)
+
+        if isdir is None:
+            isdir = (await self.stat(src)).isdir
+
+        if isdir:
+            check_download_dir(src, dst, dst_path, self.logger)
+            for item in await self.ilistdir(src):
+                name, type = item[:2]
+                src_path = src + "/" + name
+                if type == ST_TYPE_FILE:
+                    await self._download_file(src_path, dst_path + "/" + name, overwrite, quick)
+                else:
+                    await self._download(src_path, dst_path, overwrite, quick, True)
+        else:
+            await self._download_file(src, dst_path, overwrite, quick)
+
+    async def download(self, src, dst, contents, overwrite, quick):
+        """Download files from device. See EspSyncer.download for the parameters."""
+        if not os.path.isdir(dst):
+            raise Exception("download: cannot download to non-existent directory %s" % dst)
+
+        if contents:
+            st = await self.stat(src)
+            if not st or not st.isdir:
+                raise Exception("download: --contents was given but the source %s is not a directory" % src)
+            for fname in sorted(await self.ls(src)):
+                if fname not in ["..", "."]:
+                    await self._download(src + "/" + fname, dst, overwrite, quick)
+        else:
+            await self._download(src, dst, overwrite, quick)
+
+
+async def open_async_syncer(port, baudrate=DEFAULT_BAUD_RATE, timeout=DEFAULT_TIMEOUT, logger=None):
+    """Open a serial port with pyserial-asyncio, and return an AsyncEspSyncer for it.
+
+    The caller is responsible for closing the syncer's writer when it is not needed anymore."""
+    if serial_asyncio is None:
+        raise ImportError("AsyncEspSyncer requires pyserial-asyncio: python -m pip install pyserial-asyncio")
+    reader, writer = await serial_asyncio.open_serial_connection(url=port, baudrate=baudrate)
+    if logger is None:
+        def logger(s):
+            pass
+    return AsyncEspSyncer(reader, writer, timeout, logger, writer.transport.serial)
+
+
 class Main:
     def __init__(self, args):
         self.args = args
@@ -645,7 +1287,8 @@ class Main:
                 while True:
                     rerun = syncer.communicate(fin, fout, stdin_encoding, stdout_encoding,
                                                watch_file_path=watch_file_path, no_select=no_select,
-                                               timeout=args.timeout, terminator=terminator)
+                                               timeout=args.timeout, terminator=terminator,
+                                               raw_paste=command != Commands.EXECUTE.value)
                     if rerun:
                         fin.close()
                         fin = open(params[0], "rb")